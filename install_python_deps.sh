@@ -36,7 +36,7 @@ pip3 install torch torchaudio --index-url https://download.pytorch.org/whl/cpu
 
 # Instalar Whisper
 echo "🎤 Instalando Whisper..."
-pip3 install openai-whisper==20231117
+pip3 install "faster-whisper>=1.1.0"
 
 # Instalar outras dependências
 echo "📚 Instalando outras dependências..."
@@ -53,7 +53,7 @@ echo "✅ Verificando instalação..."
 python3 -c "
 import numpy as np
 import torch
-import whisper
+import faster_whisper
 import pydub
 print('✅ NumPy:', np.__version__)
 print('✅ PyTorch:', torch.__version__)
@@ -68,7 +68,7 @@ echo ""
 echo "📋 Dependências instaladas:"
 echo "   ✅ NumPy >= 1.21.0 (compatível com set_num_threads)"
 echo "   ✅ PyTorch >= 1.13.0 (CPU otimizado)"
-echo "   ✅ Whisper 20231117 (modelo de transcrição)"
+echo "   ✅ faster-whisper >= 1.1.0 (modelo de transcrição)"
 echo "   ✅ Pydub 0.25.1 (processamento de áudio)"
 echo "   ✅ FFmpeg Python (conversão de áudio)"
 echo "   ✅ TQDM (barra de progresso)"
@@ -2,8 +2,8 @@
 """
 Transcrição Simples e Eficiente
 - Sem aceleração de áudio (causa travamentos)
-- Chunks de 10 minutos para evitar travamentos
-- Paralelismo real com múltiplos processos
+- Chunks de 15 minutos decodificados uma única vez, em memória
+- Threads compartilhando um único modelo faster-whisper (CTranslate2)
 - Logs detalhados de progresso
 - Otimização máxima de CPU - TODOS OS CORES
 """
@@ -11,19 +11,21 @@ Transcrição Simples e Eficiente
 import sys
 import json
 import logging
-import whisper
+from faster_whisper import WhisperModel, BatchedInferencePipeline
 from text_processor import TextProcessor, TextProcessingRules
-from pydub import AudioSegment
 import os
 import multiprocessing
 import torch
 import numpy as np
 # Adicionando pyannote para diarização
 from pyannote.audio import Pipeline as PyannotePipeline
-from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import LocalEntryNotFoundError
 import concurrent.futures
 import subprocess
 import threading
+import bisect
+import itertools
+import wave
 
 # Configurar logging
 logging.basicConfig(
@@ -32,6 +34,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+SAMPLE_RATE = 16000
+CHUNK_DURATION_S = 15 * 60
+# Chunks cujo pico nunca passa deste nível (dBFS) são tratados como silêncio
+SILENCE_THRESHOLD_DB = -45.0
+# Mesmo limiar em amplitude PCM int16, para comparar direto com as amostras
+SILENCE_PEAK_THRESHOLD = int(32768 * 10 ** (SILENCE_THRESHOLD_DB / 20))
+# Chunks transcritos simultaneamente (threads compartilhando um único modelo)
+TRANSCRIPTION_WORKERS = 1
+# Janelas de 30s codificadas por lote no encoder do Whisper
+WHISPER_BATCH_SIZE = 8
+# VAD (Silero) do faster-whisper: só trechos com fala chegam ao encoder
+VAD_PARAMETERS = {'threshold': 0.5, 'min_silence_duration_ms': 500}
+
 def basic_text_processor():
     rules = TextProcessingRules(
         capitalize_sentences=True,
@@ -45,108 +60,188 @@ def basic_text_processor():
     )
     return TextProcessor(rules)
 
-def split_audio_streaming(file_path, chunk_duration_ms=15 * 60 * 1000):
-    """Corta o áudio em blocos de X segundos (default: 15min para maior eficiência em CPU)."""
-    audio = AudioSegment.from_file(file_path)
-    for i in range(0, len(audio), chunk_duration_ms):
-        chunk = audio[i:i + chunk_duration_ms]
-        chunk_path = f"{file_path}_chunk_{i // chunk_duration_ms}.mp3"
-        chunk.export(chunk_path, format="mp3")
-        yield chunk_path, i // chunk_duration_ms
-
-def extract_audio_if_needed(input_path):
-    """Se for vídeo, extrai o áudio para WAV mono 16kHz e retorna o novo caminho. Se já for áudio, retorna o original."""
-    audio_exts = ['.wav', '.mp3', '.flac', '.ogg', '.m4a']
-    video_exts = ['.mp4', '.mkv', '.mov', '.avi', '.webm']
-    ext = os.path.splitext(input_path)[1].lower()
-    if ext in audio_exts:
-        return input_path
-    if ext in video_exts:
-        output_path = input_path + '_audio.wav'
-        cmd = [
-            'ffmpeg', '-y', '-i', input_path,
-            '-vn', '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1', output_path
-        ]
-        subprocess.run(cmd, check=True)
-        return output_path
-    # Se extensão desconhecida, tenta processar como áudio
-    return input_path
+def read_wav_pcm_if_native(file_path):
+    """Lê um WAV que já está em PCM int16 mono 16kHz sem passar pelo ffmpeg. Retorna None caso contrário."""
+    if not file_path.lower().endswith('.wav'):
+        return None
+    try:
+        with wave.open(file_path, 'rb') as wav_file:
+            if (wav_file.getframerate() != SAMPLE_RATE or wav_file.getnchannels() != 1
+                    or wav_file.getsampwidth() != 2):
+                return None
+            raw = wav_file.readframes(wav_file.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    # WAV truncado pode terminar no meio de uma amostra: descarta o byte solto
+    return np.frombuffer(raw[:len(raw) - len(raw) % 2], dtype=np.int16)
+
+def decode_audio_pcm(file_path):
+    """Decodifica áudio ou vídeo via ffmpeg direto para PCM int16 mono 16kHz em memória (sem pydub)."""
+    samples = read_wav_pcm_if_native(file_path)
+    if samples is not None:
+        return samples
+    cmd = [
+        'ffmpeg', '-nostdin', '-i', file_path,
+        '-vn', '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-'
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        # Só o final do stderr: o ffmpeg imprime banner e metadados antes do erro
+        stderr_tail = result.stderr.decode('utf-8', errors='replace').strip()[-1000:]
+        raise RuntimeError(f"ffmpeg falhou ao decodificar '{file_path}' (código {result.returncode}): {stderr_tail}")
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+def split_audio_streaming(samples, chunk_duration_s=CHUNK_DURATION_S):
+    """Corta o áudio em blocos de X segundos (default: 15min para maior eficiência em CPU).
+
+    Recebe o buffer PCM 16kHz mono já decodificado e cada bloco é uma view dele,
+    entregue em memória ao Whisper (sem gravar arquivos de chunk).
+    """
+    chunk_samples = chunk_duration_s * SAMPLE_RATE
+    for chunk_index, start in enumerate(range(0, len(samples), chunk_samples)):
+        yield samples[start:start + chunk_samples], chunk_index
+
+def is_silent_chunk(chunk_pcm, peak_threshold=SILENCE_PEAK_THRESHOLD):
+    """Retorna True se nenhuma amostra do chunk (PCM int16) passar do limiar de pico.
+
+    Usa o pico e não a energia média: em um chunk de 15min, poucos segundos de fala
+    baixa somem na média. Só chunks realmente vazios são pulados; silêncios
+    parciais ficam a cargo do VAD do faster-whisper.
+    """
+    if chunk_pcm.size == 0:
+        return True
+    # max/min no int16 evitam o np.abs (que estoura em -32768) e o array temporário
+    return int(chunk_pcm.max()) < peak_threshold and int(chunk_pcm.min()) > -peak_threshold
+
+def load_whisper_model(**kwargs):
+    """Carrega o modelo CTranslate2 do cache local (WHISPER_MODEL_DIR ou cache do HuggingFace).
+
+    Só consulta o HuggingFace Hub quando o modelo ainda não foi baixado, evitando a
+    verificação de rede a cada execução do script.
+    """
+    download_root = os.environ.get("WHISPER_MODEL_DIR") or None
+    try:
+        return WhisperModel("small", download_root=download_root, local_files_only=True, **kwargs)
+    except LocalEntryNotFoundError:
+        logger.info("⬇️ Modelo Whisper Small não encontrado no cache local, baixando...")
+        return WhisperModel("small", download_root=download_root, **kwargs)
+
+# Modelo Whisper compartilhado por todas as threads de transcrição
+_whisper_model = None
+_whisper_model_lock = threading.Lock()
+# O BatchedInferencePipeline guarda estado mutável da transcrição em andamento
+# (last_speech_timestamp), então cada thread tem o seu em volta do modelo compartilhado
+_whisper_thread_state = threading.local()
+
+def get_whisper_model():
+    """Retorna o modelo Whisper compartilhado, carregando-o uma única vez (thread-safe)."""
+    global _whisper_model
+    with _whisper_model_lock:
+        if _whisper_model is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            # CTranslate2: pesos int8 em CPU (GEMM int8/VNNI), float16 em GPU
+            compute_type = "float16" if device == "cuda" else "int8"
+            # Paralelismo intra-op: cada worker usa sua fatia dos cores, sem oversubscription
+            cpu_threads = max(1, multiprocessing.cpu_count() // TRANSCRIPTION_WORKERS)
+            logger.info(f"🔄 Carregando modelo Whisper Small ({device}, {compute_type}, {cpu_threads} threads)...")
+            _whisper_model = load_whisper_model(
+                device=device,
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,
+                num_workers=TRANSCRIPTION_WORKERS
+            )
+            logger.info("✅ Modelo Whisper Small carregado com sucesso")
+        return _whisper_model
+
+def get_whisper_pipeline():
+    """Retorna o pipeline Whisper em lotes da thread atual (o modelo por baixo é compartilhado)."""
+    pipeline = getattr(_whisper_thread_state, 'pipeline', None)
+    if pipeline is None:
+        # Codifica várias janelas de 30s de uma vez no encoder em vez de uma por uma
+        pipeline = BatchedInferencePipeline(model=get_whisper_model())
+        _whisper_thread_state.pipeline = pipeline
+    return pipeline
 
 # Função para transcrever um chunk (para uso em paralelo)
 def transcribe_chunk(args):
-    chunk_path, chunk_index, model, text_processor = args
-    result = model.transcribe(
-        chunk_path,
+    chunk_pcm, chunk_index, text_processor = args
+    if is_silent_chunk(chunk_pcm):
+        # Evita rodar o encoder (e alucinações) em um chunk inteiro de silêncio
+        logger.info(f"🔇 Chunk {chunk_index} silencioso, pulando transcrição")
+        return []
+    pipeline = get_whisper_pipeline()
+    # Whisper aceita o array float32 16kHz diretamente, sem decodificar arquivo
+    chunk_audio = chunk_pcm.astype(np.float32)
+    chunk_audio *= 1.0 / 32768.0
+    segments_iter, _info = pipeline.transcribe(
+        chunk_audio,
         language="pt",
+        batch_size=WHISPER_BATCH_SIZE,
+        vad_filter=True,
+        vad_parameters=VAD_PARAMETERS,
+        beam_size=1,
+        # Tokens de timestamp ligados: cada trecho de até 30s do VAD volta em segmentos
+        # de frase, e não num bloco único que receberia um só locutor no alinhamento
+        without_timestamps=False,
         word_timestamps=True,
         initial_prompt=(
             "Transcreva em português do Brasil. "
             "Use linguagem formal e evite redundâncias. "
             "Corrija erros comuns e normalize números."
-        ),
-        fp16=False,
-        verbose=False,
-        condition_on_previous_text=False,
-        compression_ratio_threshold=2.4,
-        logprob_threshold=-1.0,
-        no_speech_threshold=0.6
+        )
     )
-    chunk_start_time = chunk_index * 15 * 60
+    chunk_start_time = chunk_index * CHUNK_DURATION_S
     segments = []
-    for segment in result.get("segments", []):
-        segment["start"] += chunk_start_time
-        segment["end"] += chunk_start_time
-        processed_text = text_processor.process(segment["text"])
-        segment["text"] = processed_text
-        segments.append(segment)
-    try:
-        os.remove(chunk_path)
-    except Exception:
-        pass
+    for segment in segments_iter:
+        segments.append({
+            'start': segment.start + chunk_start_time,
+            'end': segment.end + chunk_start_time,
+            'text': text_processor.process(segment.text)
+        })
     return segments
 
 def transcribe_audio(audio_path):
     try:
-        # NOVO: extrair áudio se necessário
-        original_path = audio_path
-        audio_path = extract_audio_if_needed(audio_path)
-        temp_audio = (audio_path != original_path) and audio_path.endswith('_audio.wav')
-        
         # Configurar otimização máxima de CPU
         cpu_count = setup_cpu_optimization()
         logger.info(f"🚀 Otimização de CPU configurada: {cpu_count} cores disponíveis")
         
-        text_processor = basic_text_processor()
-        logger.info("✅ Text processor inicializado")
-        
-        logger.info("🔄 Carregando modelo Whisper Small...")
-        model = whisper.load_model("small")
-        logger.info("✅ Modelo Whisper Small carregado com sucesso")
+        # Decodifica uma única vez (áudio ou vídeo); o mesmo buffer serve para diarização e chunks
+        logger.info("🎧 Decodificando áudio (16kHz mono)...")
+        samples = decode_audio_pcm(audio_path)
 
         # --- Diarização do áudio completo ---
         skip_diarization = os.environ.get("SKIP_DIARIZATION", "false").lower() == "true"
         
         if skip_diarization:
             logger.info("⏭️ Pulando diarização (SKIP_DIARIZATION=true). Usando segmentação simples...")
-            diarized_segments = create_simple_segments(audio_path)
+            diarized_segments = create_simple_segments(samples)
         else:
             logger.info("🔊 Executando diarização de locutores (pyannote, CPU)...")
             diarization_pipeline = load_pyannote_pipeline()
-            diarized_segments = diarize_audio(audio_path, diarization_pipeline)
+            diarized_segments = diarize_audio(samples, diarization_pipeline)
 
         logger.info(f"✅ Diarização concluída: {len(diarized_segments)} segmentos encontrados")
         
+        text_processor = basic_text_processor()
+        logger.info("✅ Text processor inicializado")
+
         chunk_args = []
         logger.info("📂 Dividindo áudio em chunks de 15 minutos...")
-        for chunk_path, chunk_index in split_audio_streaming(audio_path):
-            chunk_args.append((chunk_path, chunk_index, model, text_processor))
+        for chunk_pcm, chunk_index in split_audio_streaming(samples):
+            chunk_args.append((chunk_pcm, chunk_index, text_processor))
+        del samples
         
         whisper_segments = []
-        # Processar chunks em paralelo usando apenas 1 worker no servidor
-        logger.info(f"⚡ Transcrevendo {len(chunk_args)} chunks com 1 worker (sequencial)...")
-        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        # Processar chunks usando apenas 1 worker no servidor. O CTranslate2 libera o GIL,
+        # então as threads compartilham um único modelo (cada uma com seu pipeline em lotes).
+        logger.info(f"⚡ Transcrevendo {len(chunk_args)} chunks com {TRANSCRIPTION_WORKERS} worker(s)...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS) as executor:
             for chunk_result in executor.map(transcribe_chunk, chunk_args):
                 whisper_segments.extend(chunk_result)
+        # Os chunks são views do buffer PCM decodificado; liberar a lista libera o buffer inteiro
+        num_chunks = len(chunk_args)
+        del chunk_args
         logger.info(f"✅ Transcrição concluída: {len(whisper_segments)} segmentos")
 
         # --- Alinhar segmentos do Whisper com locutores ---
@@ -171,31 +266,17 @@ def transcribe_audio(audio_path):
             formatted_segments.append(f"{start_str} {locutor}: {seg['text']}")
         formatted_text = "\n".join(formatted_segments)
         logger.info(f"🎉 Transcrição e diarização concluídas!")
-        logger.info(f"📊 Resumo: {len(chunk_args)} chunks, {len(aligned)} segmentos, {len(formatted_text)} caracteres")
+        logger.info(f"📊 Resumo: {num_chunks} chunks, {len(aligned)} segmentos, {len(formatted_text)} caracteres")
         result = json.dumps({
             "status": "success",
             "text": formatted_text.strip(),
             "segments": aligned,
-            "chunks": len(chunk_args),
+            "chunks": num_chunks,
             "language": "pt"
         }, ensure_ascii=False)
-        # Limpeza automática do áudio temporário extraído
-        if temp_audio and os.path.exists(audio_path):
-            try:
-                os.remove(audio_path)
-                logger.info(f"🗑️ Áudio temporário removido: {audio_path}")
-            except Exception as e:
-                logger.warning(f"⚠️ Erro ao remover áudio temporário: {e}")
         return result
     except Exception as e:
         logger.error(f"❌ Erro na transcrição: {e}")
-        # Limpeza em caso de erro
-        if temp_audio and os.path.exists(audio_path):
-            try:
-                os.remove(audio_path)
-                logger.info(f"🗑️ Áudio temporário removido após erro: {audio_path}")
-            except Exception:
-                pass
         raise
 
 def load_pyannote_pipeline():
@@ -206,6 +287,11 @@ def load_pyannote_pipeline():
     pipeline = PyannotePipeline.from_pretrained("pyannote/speaker-diarization-3.1", use_auth_token=hf_token)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     pipeline.to(device)
+    # Lotes grandes ocupam bem a GPU; em CPU, lotes menores mantêm o working set no cache
+    # (o default 32 só aumenta o uso de memória)
+    batch_size = 32 if device.type == "cuda" else 8
+    pipeline.segmentation_batch_size = batch_size
+    pipeline.embedding_batch_size = batch_size
     return pipeline
 
 def setup_cpu_optimization():
@@ -215,17 +301,30 @@ def setup_cpu_optimization():
     
     # Configurar PyTorch para usar todos os cores
     try:
-        if torch.cuda.is_available():
-            torch.set_num_threads(cpu_count)
-            logger.info(f"PyTorch CUDA configurado para {cpu_count} threads")
-        else:
-            # Para CPU, usar todos os cores disponíveis
-            torch.set_num_threads(cpu_count)
-            torch.set_num_interop_threads(cpu_count)
-            logger.info(f"PyTorch CPU configurado para {cpu_count} threads")
+        # Todos os cores vão para o paralelismo intra-op; o inter-op fica em 1 thread para
+        # não multiplicar threads (N inter-op x N intra-op) nos grafos sequenciais do pyannote
+        torch.set_num_threads(cpu_count)
+        torch.set_num_interop_threads(1)
+        logger.info(f"PyTorch configurado para {cpu_count} threads")
     except Exception as e:
+        # set_num_interop_threads falha se já houve trabalho inter-op neste processo
         logger.warning(f"Erro ao configurar PyTorch threads: {e}")
         pass
+
+    # Flags de backend CUDA em bloco separado: uma falha nas threads não pode desativá-las
+    if torch.cuda.is_available():
+        try:
+            # Shapes de entrada fixos (janelas do pyannote): o autotune do cuDNN compensa já no 1º lote
+            torch.backends.cudnn.benchmark = True
+            logger.info("PyTorch CUDA configurado (cuDNN benchmark)")
+        except Exception as e:
+            logger.warning(f"Erro ao configurar backend CUDA do PyTorch: {e}")
+    else:
+        # Saídas de baixa magnitude do SincNet geram denormais, muito lentos em CPU: zera-os
+        if torch.set_flush_denormal(True):
+            logger.info("PyTorch CPU configurado para descartar denormais (flush-to-zero)")
+        else:
+            logger.info("CPU sem suporte a flush de denormais, mantendo o padrão")
     
     # Configurar NumPy para usar todos os cores (compatibilidade)
     try:
@@ -250,11 +349,32 @@ def setup_cpu_optimization():
     
     return cpu_count
 
-def diarize_audio(audio_path, pipeline=None):
-    """Executa diarização e retorna lista de segmentos: [{'speaker': 'SPEAKER_00', 'start': float, 'end': float}]"""
+def get_speaker_bounds():
+    """Retorna os limites de locutores para o pyannote a partir de MAX_SPEAKERS ({} se não definido ou inválido)."""
+    # Limite de locutores (MAX_SPEAKERS) restringe o espaço de busca do clustering
+    max_speakers = os.environ.get("MAX_SPEAKERS", "").strip()
+    if not max_speakers:
+        return {}
+    try:
+        max_speakers_value = int(max_speakers)
+    except ValueError:
+        max_speakers_value = 0
+    if max_speakers_value <= 0:
+        logger.warning(f"⚠️ MAX_SPEAKERS inválido ({max_speakers!r}), ignorando limite de locutores")
+        return {}
+    return {'max_speakers': max_speakers_value}
+
+def diarize_audio(samples, pipeline=None):
+    """Executa diarização e retorna lista de segmentos: [{'speaker': 'SPEAKER_00', 'start': float, 'end': float}]
+
+    Recebe o PCM int16 16kHz mono já decodificado e entrega o waveform em memória ao pyannote,
+    que assim não relê nem reamostra o arquivo.
+    """
     if pipeline is None:
         pipeline = load_pyannote_pipeline()
-    diarization = pipeline(audio_path)
+    waveform = torch.from_numpy(samples.astype(np.float32)).unsqueeze(0)
+    waveform *= 1.0 / 32768.0
+    diarization = pipeline({"waveform": waveform, "sample_rate": SAMPLE_RATE}, **get_speaker_bounds())
     diarized_segments = []
     for turn, _, speaker in diarization.itertracks(yield_label=True):
         diarized_segments.append({
@@ -264,10 +384,9 @@ def diarize_audio(audio_path, pipeline=None):
         })
     return diarized_segments
 
-def create_simple_segments(audio_path, segment_duration=30):
-    """Cria segmentos simples baseados em tempo quando diarização falha."""
-    audio = AudioSegment.from_file(audio_path)
-    duration_seconds = len(audio) / 1000
+def create_simple_segments(samples, segment_duration=30):
+    """Cria segmentos simples baseados em tempo quando diarização falha (a partir do PCM 16kHz já decodificado)."""
+    duration_seconds = len(samples) / SAMPLE_RATE
     segments = []
     
     for i in range(0, int(duration_seconds), segment_duration):
@@ -281,10 +400,19 @@ def create_simple_segments(audio_path, segment_duration=30):
 
 def align_segments_with_speakers(whisper_segments, diarized_segments):
     """Alinha os segmentos do Whisper com os segmentos diarizados por maior interseção temporal."""
+    # Turnos ordenados por início + maior fim acumulado: só os turnos em [lo, hi) podem ter
+    # interseção com [start, end), então a busca é binária em vez de varrer todos os turnos
+    turns = sorted(diarized_segments, key=lambda seg: seg['start'])
+    turn_starts = [seg['start'] for seg in turns]
+    turn_max_ends = list(itertools.accumulate((seg['end'] for seg in turns), max))
+
     def find_best_speaker(start, end):
         best_speaker = None
         max_overlap = 0
-        for seg in diarized_segments:
+        lo = bisect.bisect_right(turn_max_ends, start)
+        hi = bisect.bisect_left(turn_starts, end)
+        for i in range(lo, hi):
+            seg = turns[i]
             overlap = max(0, min(end, seg['end']) - max(start, seg['start']))
             if overlap > max_overlap:
                 max_overlap = overlap
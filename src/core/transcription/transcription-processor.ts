@@ -365,11 +365,11 @@ export class TranscriptionProcessor {
       let whisperAvailable = false;
       if (pythonAvailable) {
         try {
-          await execAsync('python3 -c "import whisper"');
+          await execAsync('python3 -c "import faster_whisper"');
           whisperAvailable = true;
         } catch (e) {
           try {
-            await execAsync('python -c "import whisper"');
+            await execAsync('python -c "import faster_whisper"');
             whisperAvailable = true;
           } catch (e) {
             // Whisper não disponível
@@ -402,7 +402,7 @@ export class TranscriptionProcessor {
       const recommendations: string[] = [];
       if (!pythonAvailable) recommendations.push('Instalar Python 3.8+');
       if (!scriptAvailable) recommendations.push('Verificar arquivo transcribe.py');
-      if (!whisperAvailable) recommendations.push('Instalar OpenAI Whisper: pip install openai-whisper');
+      if (!whisperAvailable) recommendations.push('Instalar faster-whisper: pip install faster-whisper');
       if (!ffmpegAvailable) recommendations.push('Instalar FFmpeg');
       if (memoryUsage > 90) recommendations.push('Liberar memória RAM');
       if (cpuCores < 4) recommendations.push('Considerar hardware com mais cores');
@@ -333,7 +333,7 @@ export class VideoRepository {
       
       let whisperAvailable = false;
       if (pythonAvailable) {
-        whisperAvailable = await execAsync('python -c "import whisper"')
+        whisperAvailable = await execAsync('python -c "import faster_whisper"')
           .then(() => true)
           .catch(() => false);
       }